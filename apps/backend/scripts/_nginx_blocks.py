@@ -0,0 +1,223 @@
+"""
+Brace matching (plus a cheap file probe and an atomic writer) shared by the nginx patch scripts in this directory.
+
+The scripts are run as `python3 <script>.py`, which puts this directory on sys.path,
+so they import it as a plain sibling module.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import mmap
+import os
+import re
+import stat
+from pathlib import Path
+from typing import Iterator, Optional
+
+_RE_SERVER_OPEN = re.compile(r"\bserver\s*\{")
+# `location = /me {` header, used by the /me/* clone in both vhost patchers.
+# `indent` is spaces/tabs only: `\s*` would also swallow preceding blank lines into it.
+RE_LOC_ME_EXACT = re.compile(r"^(?P<indent>[ \t]*)location\s*=\s*/me\s*\{", flags=re.MULTILINE)
+# Characters after which a `#` begins a comment (otherwise it is part of a token, e.g. `/#/login`).
+_COMMENT_START_AFTER = frozenset(" \t\r;{}")
+
+
+@contextlib.contextmanager
+def mapped_file(path: Path) -> Iterator[Optional[mmap.mmap]]:
+    """
+    Yields a read-only mmap of the file, or None if the file is empty.
+    Lets callers run several probes on one mapping and decide NOOP/ERROR before reading and decoding it.
+    """
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file: mmap refuses zero-length mappings.
+            yield None
+            return
+        with mm:
+            yield mm
+
+
+def file_contains(path: Path, needle: bytes) -> bool:
+    """
+    True if the file contains `needle`.
+    """
+    with mapped_file(path) as mm:
+        return mm is not None and mm.find(needle) != -1
+
+
+def write_atomic(path: Path, content: str) -> None:
+    """
+    Replaces the file at `path` with `content` (UTF-8): writes a temp file next to it, fsyncs it
+    and renames it over the target, so nginx never sees a half-written or (after a crash) empty vhost.
+    Symlinks are resolved first (sites-enabled -> sites-available) and stay links; the file keeps its mode.
+    The old inode is never modified, so hard-link backups of it stay intact.
+    """
+    target = Path(os.path.realpath(path))
+    tmp = target.with_name(f".{target.name}.tmp.{os.getpid()}")
+    data = content.encode("utf-8")
+    try:
+        mode: Optional[int] = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = None
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            if mode is not None:
+                os.fchmod(fd, mode)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            # The rename must not land before the data does, or a crash leaves an empty vhost.
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def in_comment(text: str, idx: int) -> bool:
+    """
+    True if `idx` sits inside an nginx comment. As in nginx, `#` and quotes only count
+    at the start of a token (line start, or after whitespace, `;`, `{`, `}`), and `#` not inside quotes.
+    So a `#` inside a value such as an SPA hash route is not a comment, and an apostrophe
+    inside a word does not open a quote:
+
+    >>> t = "location = /login { return 302 /#/login; }"
+    >>> in_comment(t, t.index("}")), find_block_end(t, t.index("{")) == len(t)
+    (False, True)
+    >>> in_comment("    # note: { not a block }", 12)
+    True
+    >>> in_comment('add_header X "a #b" ; }', 22)
+    False
+    >>> t = "return 200 it's; # }"
+    >>> in_comment(t, t.index("}"))
+    True
+    """
+    line_start = text.rfind("\n", 0, idx) + 1
+    if text.find("#", line_start, idx) == -1:
+        return False
+    quote = ""
+    i = line_start
+    while i < idx:
+        ch = text[i]
+        if quote:
+            if ch == "\\":
+                i += 1
+            elif ch == quote:
+                quote = ""
+        elif i == line_start or text[i - 1] in _COMMENT_START_AFTER:
+            if ch == '"' or ch == "'":
+                quote = ch
+            elif ch == "#":
+                return True
+        i += 1
+    return False
+
+
+def _find_code(text: str, ch: str, start: int, stop: int | None = None) -> int:
+    # str.find that skips hits inside comments by resuming at the next line.
+    i = text.find(ch, start, stop)
+    while i != -1 and in_comment(text, i):
+        nl = text.find("\n", i, stop)
+        if nl == -1:
+            return -1
+        i = text.find(ch, nl, stop)
+    return i
+
+
+def find_block_end(text: str, brace_open: int, stop: int | None = None) -> int:
+    """
+    Returns the index just past the `}` matching the `{` at `brace_open`, or -1 if unbalanced.
+    Jumps between braces with str.find instead of walking the text char by char;
+    braces in `#` comments are not counted.
+    With `stop`, braces at or past it are not looked at: a block still open there counts as unbalanced.
+    """
+    depth = 1
+    next_open = _find_code(text, "{", brace_open + 1, stop)
+    next_close = _find_code(text, "}", brace_open + 1, stop)
+    while next_close != -1:
+        if next_open != -1 and next_open < next_close:
+            depth += 1
+            next_open = _find_code(text, "{", next_open + 1, stop)
+        else:
+            depth -= 1
+            if depth == 0:
+                return next_close + 1
+            next_close = _find_code(text, "}", next_close + 1, stop)
+    return -1
+
+
+def extract_braced_block(text: str, start_idx: int, stop: int | None = None) -> tuple[str, int]:
+    """
+    Returns (text, end_idx) from `start_idx` through the `}` closing the first `{` after it,
+    or ("", -1) if there is no balanced block (before `stop`, if given).
+    """
+    brace_open = _find_code(text, "{", start_idx, stop)
+    if brace_open == -1:
+        return ("", -1)
+    end = find_block_end(text, brace_open, stop)
+    if end == -1:
+        return ("", -1)
+    return (text[start_idx:end], end)
+
+
+def iter_server_blocks(text: str) -> Iterator[tuple[int, int]]:
+    """
+    Yields (start_idx, end_idx) for top-level `server { ... }` blocks, in file order.
+    Stops at the first unbalanced block rather than guess (and corrupt the file).
+    """
+    i = 0
+    while True:
+        m = _RE_SERVER_OPEN.search(text, i)
+        if not m:
+            return
+        if in_comment(text, m.start()):
+            i = m.end()
+            continue
+        end = find_block_end(text, m.end() - 1)
+        if end == -1:
+            return
+        yield (m.start(), end)
+        i = end
+
+
+def next_server_start(text: str, pos: int) -> int | None:
+    """
+    Returns the start of the first uncommented `server {` header at or after `pos`, or None.
+    Server blocks don't nest, so this is a safe upper bound for brace matching inside the current one.
+    """
+    m = _RE_SERVER_OPEN.search(text, pos)
+    while m and in_comment(text, m.start()):
+        m = _RE_SERVER_OPEN.search(text, m.end())
+    return m.start() if m else None
+
+
+def enclosing_server_block(text: str, idx: int) -> tuple[int, int] | None:
+    """
+    Returns (start_idx, end_idx) of the `server { ... }` block containing `idx`, or None.
+    Steps back to the nearest uncommented `server {` header before `idx` with str.rfind,
+    so only that one block is brace-matched.
+    """
+    k = text.rfind("server", 0, idx)
+    while k != -1:
+        m = _RE_SERVER_OPEN.match(text, k)
+        if m and not in_comment(text, k):
+            end = find_block_end(text, m.end() - 1)
+            # Server blocks don't nest: if the nearest one closed before `idx`, nothing encloses it.
+            if end == -1 or end <= idx:
+                return None
+            return (k, end)
+        k = text.rfind("server", 0, k)
+    return None
+
+
+def server_blocks(text: str) -> list[tuple[int, int]]:
+    return list(iter_server_blocks(text))
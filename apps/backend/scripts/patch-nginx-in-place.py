@@ -11,16 +11,22 @@ This script is intended to be run on the VPS with sudo.
 from __future__ import annotations
 
 import argparse
-import datetime as _dt
+import errno
+import functools
 import os
 import re
 import shutil
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable, Optional
 
+from _nginx_blocks import RE_LOC_ME_EXACT, extract_braced_block, find_block_end, server_blocks, write_atomic
 
+
+NGINX_CONF = Path("/etc/nginx/nginx.conf")
 NGINX_SITES_AVAILABLE = Path("/etc/nginx/sites-available")
 NGINX_SITES_ENABLED = Path("/etc/nginx/sites-enabled")
 NGINX_CONF_D = Path("/etc/nginx/conf.d")
@@ -30,9 +36,59 @@ FAIL2BAN_JAIL_D = Path("/etc/fail2ban/jail.d")
 
 MARKER = "# memalerts-managed"
 
+# Backend namespaces proxied by `_ensure_memalerts_api_proxy_locations`.
+# wallet/memes are requested without trailing slash by some clients, so they also get an exact location.
+API_PREFIXES = ("auth", "webhooks", "public", "submissions", "channels", "wallet", "memes", "streamer", "owner", "moderation")
+API_EXACT_PREFIXES = frozenset({"wallet", "memes"})
+
+# Compiled once at import: these run for every server block of every vhost file.
+_RE_GZIP_ON = re.compile(rb"^\s*gzip\s+on\s*;", flags=re.MULTILINE)
+# The SPA fallback we insert in front of, at whatever indent (tabs, 2 or 4 spaces) the vhost uses.
+_RE_LOC_ROOT = re.compile(r"\n[ \t]*location\s+/\s*\{")
+_RE_LOC_UPLOADS = re.compile(r"(^\s*location\s+/uploads/\s*\{)", flags=re.MULTILINE)
+# One pass over a server block finds every location header the API patcher cares about:
+# the fixed ones by group name, plus `location = /<prefix>` and `location ^~ /<prefix>/`.
+_API_PREFIX_ALT = "|".join(map(re.escape, API_PREFIXES))
+_RE_LOC_API_HEADERS = re.compile(
+    r"^\s*location\s+(?:"
+    r"(?P<internal>\^~\s+/internal/)"
+    r"|(?P<health>=\s*/health)"
+    r"|(?P<me_exact>=\s*/me)"
+    r"|(?P<me_prefix>\^~\s+/me/)"
+    r"|(?P<socket_io>/socket\.io/)"
+    r"|(?P<api>\^~\s+/api/)"
+    rf"|=\s*/(?P<exact>{_API_PREFIX_ALT})"
+    rf"|\^~\s+/(?P<slash>{_API_PREFIX_ALT})/"
+    r")\s*\{",
+    flags=re.MULTILINE,
+)
+
+# Directives added to an existing /uploads/ location when missing: probe group name -> line.
+UPLOADS_DIRECTIVES = {
+    "expires": "        expires 30d;\n",
+    "cache_control": '        add_header Cache-Control "public, max-age=2592000, immutable" always;\n',
+    "accept_ranges": '        add_header Accept-Ranges "bytes" always;\n',
+    "try_files": "        try_files $uri =404;\n",
+}
+_RE_UPLOADS_PROBE = re.compile(
+    r"(?P<expires>expires )|(?P<cache_control>Cache-Control)|(?P<accept_ranges>Accept-Ranges)|(?P<try_files>try_files)"
+)
+
+# Locations that get a `limit_req`: regex group name -> (location match, zone, burst).
+RATE_LIMITS = {
+    "me": (r"=\s*/me", "memalerts_api_per_ip", 30),
+    "auth": (r"\^~\s+/auth/", "memalerts_auth_per_ip", 10),
+    "socket_io": (r"/socket\.io/", "memalerts_api_per_ip", 60),
+    "root": (r"/", "memalerts_api_per_ip", 80),
+}
+_RE_RATE_LIMITED_LOC = re.compile(
+    r"^\s*location\s+(?:" + "|".join(f"(?P<{name}>{pat})" for name, (pat, _, _) in RATE_LIMITS.items()) + r")\s*\{",
+    flags=re.MULTILINE,
+)
+
 
 def _now_tag() -> str:
-    return _dt.datetime.now(_dt.timezone.utc).strftime("%Y%m%d-%H%M%S")
+    return time.strftime("%Y%m%d-%H%M%S", time.gmtime())
 
 
 def _die(msg: str, code: int = 2) -> None:
@@ -40,9 +96,9 @@ def _die(msg: str, code: int = 2) -> None:
     raise SystemExit(code)
 
 
-def _read_text(path: Path) -> str:
+def _read_bytes(path: Path) -> bytes:
     try:
-        return path.read_text(encoding="utf-8")
+        return path.read_bytes()
     except FileNotFoundError:
         _die(f"File not found: {path}")
     except PermissionError:
@@ -52,9 +108,10 @@ def _read_text(path: Path) -> str:
 def _write_text(path: Path, content: str, *, dry_run: bool) -> None:
     if dry_run:
         return
+    # Never truncate in place: backups may be hard links to the current inode.
     try:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        path.write_text(content, encoding="utf-8")
+        Path(os.path.realpath(path)).parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(path, content)
     except PermissionError:
         _die(f"Permission denied writing: {path}. Run with sudo.")
 
@@ -69,17 +126,48 @@ def _backup_file(path: Path, *, dry_run: bool) -> Optional[Path]:
     if dry_run:
         return backup_path
     NGINX_BACKUP_DIR.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(path, backup_path)
-    return backup_path
+    n = 0
+    link = True
+    while True:
+        try:
+            if link:
+                # Same filesystem: a hard link is enough, since _write_text never modifies the old inode.
+                os.link(path, backup_path)
+            else:
+                with open(path, "rb") as src, open(backup_path, "xb") as dst:
+                    shutil.copyfileobj(src, dst)
+                shutil.copystat(path, backup_path)
+            return backup_path
+        except FileExistsError:
+            # Name taken (e.g. a same-named file from the other sites dir, backed up this second).
+            # Never write into it: it can be a hard link to another file's inode. Take the next suffix.
+            n += 1
+            backup_path = NGINX_BACKUP_DIR / f"{backup_name}.{n}"
+        except OSError as e:
+            # Only "can't hard-link here" falls back to a copy; anything else is a real error.
+            if not link or e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            link = False
+
+
+@functools.lru_cache(maxsize=None)
+def _dir_names(dir_path: Path) -> frozenset[str]:
+    # One listing per directory answers every existence check in it (conf.d holds both of our snippets).
+    try:
+        return frozenset(os.listdir(dir_path))
+    except FileNotFoundError:
+        return frozenset()
 
 
 def _ensure_file_if_missing(path: Path, content: str, *, dry_run: bool) -> bool:
     """
     Returns True if file was created, False if already existed.
     """
-    if path.exists():
+    if path.name in _dir_names(path.parent):
         return False
     _write_text(path, content, dry_run=dry_run)
+    if not dry_run:
+        _dir_names.cache_clear()
     return True
 
 
@@ -89,6 +177,18 @@ class PatchResult:
     details: list[str]
 
 
+@functools.lru_cache(maxsize=1)
+def _nginx_conf_has_gzip() -> bool:
+    try:
+        raw = NGINX_CONF.read_bytes()
+    except FileNotFoundError:
+        return False
+    # Cheap byte screen first; the anchored multiline regex only runs when "gzip" appears at all.
+    if b"gzip" not in raw:
+        return False
+    return _RE_GZIP_ON.search(raw) is not None
+
+
 def ensure_gzip_conf(*, dry_run: bool) -> PatchResult:
     path = NGINX_CONF_D / "memalerts-compress.conf"
     # Many distros already enable gzip in /etc/nginx/nginx.conf.
@@ -96,11 +196,8 @@ def ensure_gzip_conf(*, dry_run: bool) -> PatchResult:
     # "duplicate directive". Therefore: if nginx.conf exists and already contains
     # gzip directives, skip creating our gzip conf altogether.
     try:
-        nginx_conf = Path("/etc/nginx/nginx.conf")
-        if nginx_conf.exists():
-            raw = nginx_conf.read_text(encoding="utf-8", errors="ignore")
-            if re.search(r"^\s*gzip\s+on\s*;", raw, flags=re.MULTILINE):
-                return PatchResult(changed=False, details=[f"skip gzip (already enabled): {path}"])
+        if _nginx_conf_has_gzip():
+            return PatchResult(changed=False, details=[f"skip gzip (already enabled): {path}"])
     except Exception:
         # Best-effort: if we can't read nginx.conf, fall back to old behavior below.
         pass
@@ -143,70 +240,57 @@ def ensure_rate_limit_zones_conf(*, dry_run: bool) -> PatchResult:
     return PatchResult(changed=created, details=[f"create {path}"] if created else [f"keep {path}"])
 
 
-def _iter_files(dir_path: Path) -> Iterable[Path]:
-    if not dir_path.exists():
+def _iter_files(dir_path: Path) -> Iterable[os.DirEntry[str]]:
+    # DirEntry caches the file type from readdir() and its stat() result, so each entry is stat'ed at most once.
+    try:
+        with os.scandir(dir_path) as it:
+            entries = sorted((e for e in it if e.is_file()), key=lambda e: e.name)
+    except FileNotFoundError:
         return
-    for p in sorted(dir_path.iterdir()):
-        if p.is_file():
-            yield p
+    yield from entries
 
 
 def _iter_nginx_site_files() -> Iterable[Path]:
     """
     Scan both sites-available and sites-enabled.
-    We de-duplicate by resolved real path to avoid double-patching symlinked vhosts.
+    We de-duplicate by (device, inode) of the target file to avoid double-patching symlinked vhosts.
     """
-    seen: set[Path] = set()
+    seen: set[tuple[int, int]] = set()
     for base in (NGINX_SITES_AVAILABLE, NGINX_SITES_ENABLED):
-        for p in _iter_files(base):
+        for e in _iter_files(base):
             try:
-                real = p.resolve()
-            except Exception:
-                real = p
-            if real in seen:
+                st = e.stat()
+            except OSError:
+                # Vanished (or dangling) since the directory was listed.
                 continue
-            seen.add(real)
-            yield p
+            key = (st.st_dev, st.st_ino)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield Path(e.path)
 
 
-def _server_blocks(text: str) -> list[tuple[int, int]]:
+def _server_names(text: str, start: int = 0, end: Optional[int] = None) -> list[str]:
     """
-    Returns list of (start_idx, end_idx) for top-level 'server { ... }' blocks.
-    Very small brace parser to avoid regex disasters.
+    Returns names from the first `server_name` directive in text[start:end].
+    Searching with bounds lets callers probe a server block without slicing it out.
     """
-    blocks: list[tuple[int, int]] = []
-    i = 0
-    n = len(text)
-    while i < n:
-        m = re.search(r"\bserver\s*\{", text[i:])
-        if not m:
-            break
-        start = i + m.start()
-        j = start + m.end() - m.start()
-        depth = 0
-        while j < n:
-            ch = text[j]
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    end = j + 1
-                    blocks.append((start, end))
-                    i = end
-                    break
-            j += 1
-        else:
-            # Unbalanced braces; stop to avoid corrupting the file.
+    if end is None:
+        end = len(text)
+    k = text.find("server_name", start, end)
+    while k != -1:
+        after = k + len("server_name")
+        # Must be a directive: only whitespace before it on its line, whitespace after the keyword.
+        line_start = text.rfind("\n", 0, k) + 1
+        if after < end and text[after].isspace() and not text[line_start:k].strip():
             break
-    return blocks
-
-
-def _server_names(server_block: str) -> list[str]:
-    m = re.search(r"^\s*server_name\s+([^;]+);", server_block, flags=re.MULTILINE)
-    if not m:
+        k = text.find("server_name", after, end)
+    if k == -1:
+        return []
+    semi = text.find(";", after, end)
+    if semi == -1:
         return []
-    raw = m.group(1)
+    raw = text[after:semi]
     names: list[str] = []
     for part in raw.split():
         part = part.strip()
@@ -217,9 +301,12 @@ def _server_names(server_block: str) -> list[str]:
     return names
 
 
+_PLACEHOLDER_DOMAINS = frozenset({"site.ru", "example.com", "domain.com"})
+
+
 def _normalize_domain(d: str) -> str:
     d = d.strip()
-    if not d or d.lower() in {"site.ru", "example.com", "domain.com"}:
+    if not d or d.lower() in _PLACEHOLDER_DOMAINS:
         _die(f"Refusing placeholder domain: {d}. Pass your real domain.")
     return d
 
@@ -229,15 +316,12 @@ def _ensure_uploads_location(server_block: str, *, uploads_alias_dir: str) -> tu
     Ensures there's a location /uploads/ block with caching headers.
     If location exists, we add only missing cache directives.
     """
-    changed = False
-
     # Normalize alias path: must end with /
     alias_dir = uploads_alias_dir
     if not alias_dir.endswith("/"):
         alias_dir += "/"
 
-    loc_re = re.compile(r"(^\s*location\s+/uploads/\s*\{)", flags=re.MULTILINE)
-    m = loc_re.search(server_block)
+    m = _RE_LOC_UPLOADS.search(server_block)
     if not m:
         # Insert before location / { if present, else before final } of server
         location_uploads = (
@@ -251,73 +335,34 @@ def _ensure_uploads_location(server_block: str, *, uploads_alias_dir: str) -> tu
             "        try_files $uri =404;\n"
             "    }\n"
         )
-        insert_point = server_block.find("\n    location / {")
-        if insert_point == -1:
-            insert_point = server_block.rfind("\n}")
-        if insert_point == -1:
-            return (server_block, False)
-        server_block = server_block[:insert_point] + location_uploads + server_block[insert_point:]
-        return (server_block, True)
+        return _insert_location_block(server_block, location_uploads)
 
     # Location exists — patch inside it if needed.
-    # Find the braces for this location block.
     start = m.start(1)
-    brace_open = server_block.find("{", start)
-    if brace_open == -1:
+    loc_block, loc_end = extract_braced_block(server_block, start)
+    if loc_end == -1:
         return (server_block, False)
-    j = brace_open + 1
-    depth = 1
-    while j < len(server_block):
-        ch = server_block[j]
-        if ch == "{":
-            depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0:
-                loc_end = j + 1
-                loc_block = server_block[start:loc_end]
-                patched = loc_block
-                # Only add if missing
-                if "expires " not in loc_block:
-                    patched = patched[:-1] + "        expires 30d;\n" + "    }\n"
-                    changed = True
-                if "Cache-Control" not in loc_block:
-                    patched = patched[:-1] + '        add_header Cache-Control "public, max-age=2592000, immutable" always;\n' + "    }\n"
-                    changed = True
-                if "Accept-Ranges" not in loc_block:
-                    patched = patched[:-1] + '        add_header Accept-Ranges "bytes" always;\n' + "    }\n"
-                    changed = True
-                if "try_files" not in loc_block:
-                    patched = patched[:-1] + "        try_files $uri =404;\n" + "    }\n"
-                    changed = True
-                if changed:
-                    server_block = server_block[:start] + patched + server_block[loc_end:]
-                return (server_block, changed)
-        j += 1
-
-    return (server_block, False)
-
-
-def _ensure_location_if_missing(
-    server_block: str,
-    *,
-    location_header_regex: str,
-    location_block: str,
-) -> tuple[str, bool]:
-    """
-    Ensure a `location ... { ... }` block exists inside a server block.
-
-    - If a matching location header is found, do nothing.
-    - Otherwise, insert the block before `location / {` (SPA fallback usually),
-      else before the final `}` of the server block.
-    """
-    loc_re = re.compile(location_header_regex, flags=re.MULTILINE)
-    if loc_re.search(server_block):
+    # Only add if missing
+    present = {p.lastgroup for p in _RE_UPLOADS_PROBE.finditer(server_block, start, loc_end)}
+    missing = [line for name, line in UPLOADS_DIRECTIVES.items() if name not in present]
+    if not missing:
         return (server_block, False)
 
-    insert_point = server_block.find("\n    location / {")
-    if insert_point == -1:
-        insert_point = server_block.rfind("\n}")
+    # Re-open the block: drop the closing `}` with its indent, append directives, close it again.
+    body = loc_block[:-1].rstrip(" \t")
+    if not body.endswith("\n"):
+        body += "\n"
+    patched = body + "".join(missing) + "    }"
+    server_block = server_block[:start] + patched + server_block[loc_end:]
+    return (server_block, True)
+
+
+def _insert_location_block(server_block: str, location_block: str) -> tuple[str, bool]:
+    """
+    Insert the block before `location / {` (SPA fallback usually), else before the final `}`.
+    """
+    m = _RE_LOC_ROOT.search(server_block)
+    insert_point = m.start() if m else server_block.rfind("\n}")
     if insert_point == -1:
         return (server_block, False)
 
@@ -357,109 +402,95 @@ def _ensure_memalerts_api_proxy_locations(server_block: str, *, upstream_port: i
     changed = False
     upstream = f"http://127.0.0.1:{int(upstream_port)}"
 
-    def _extract_braced_block(s: str, start_idx: int) -> tuple[str, int]:
-        brace_open = s.find("{", start_idx)
-        if brace_open == -1:
-            return ("", -1)
-        i = brace_open + 1
-        depth = 1
-        while i < len(s):
-            ch = s[i]
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    end = i + 1
-                    return (s[start_idx:end], end)
-            i += 1
-        return ("", -1)
+    # Collect every location we might add in a single scan; inserts below only add what is missing.
+    present: set[str] = set()
+    for m in _RE_LOC_API_HEADERS.finditer(server_block):
+        if m.lastgroup == "exact":
+            present.add(f"= /{m['exact']}")
+        elif m.lastgroup == "slash":
+            present.add(f"^~ /{m['slash']}/")
+        else:
+            present.add(m.lastgroup)
 
     # Block internal relay endpoints externally (security-critical).
-    server_block, c0 = _ensure_location_if_missing(
-        server_block,
-        location_header_regex=r"(^\s*location\s+\^~\s+/internal/\s*\{)",
-        location_block=(
-            f"    {MARKER}: block internal relay\n"
-            "    location ^~ /internal/ {\n"
-            "        return 404;\n"
-            "    }\n"
-        ),
-    )
-    changed = changed or c0
+    if "internal" not in present:
+        server_block, c0 = _insert_location_block(
+            server_block,
+            (
+                f"    {MARKER}: block internal relay\n"
+                "    location ^~ /internal/ {\n"
+                "        return 404;\n"
+                "    }\n"
+            ),
+        )
+        changed = changed or c0
 
     # Health: make sure ops checks reach backend, not the SPA.
-    server_block, c1 = _ensure_location_if_missing(
-        server_block,
-        location_header_regex=r"(^\s*location\s+=\s*/health\s*\{)",
-        location_block=(
-            f"    {MARKER}: api proxy\n"
-            "    location = /health {\n"
-            f"        proxy_pass {upstream};\n"
-            f"{_proxy_common_headers()}"
-            "    }\n"
-        ),
-    )
-    changed = changed or c1
+    if "health" not in present:
+        server_block, c1 = _insert_location_block(
+            server_block,
+            (
+                f"    {MARKER}: api proxy\n"
+                "    location = /health {\n"
+                f"        proxy_pass {upstream};\n"
+                f"{_proxy_common_headers()}"
+                "    }\n"
+            ),
+        )
+        changed = changed or c1
 
     # /me and /me/* (avoid matching /memes)
     #
     # Real-world nginx configs often already have `location = /me { ... }` with a lot
     # of headers (Cookie, CF-Connecting-IP, timeouts). If so, the safest fix for
     # `/me/preferences` is to clone that exact block into `location ^~ /me/ { ... }`.
-    if not re.search(r"^\s*location\s+\^~\s+/me/\s*\{", server_block, flags=re.MULTILINE):
-        m_me_exact = re.search(r"^(?P<indent>\s*)location\s*=\s*/me\s*\{", server_block, flags=re.MULTILINE)
+    if "me_prefix" not in present:
+        m_me_exact = RE_LOC_ME_EXACT.search(server_block)
         if m_me_exact:
             start = m_me_exact.start(0)
             indent = m_me_exact.group("indent")
-            block, end = _extract_braced_block(server_block, start)
+            block, end = extract_braced_block(server_block, start)
             if block and end != -1:
-                cloned = re.sub(
-                    r"^(\s*)location\s*=\s*/me\s*\{",
-                    r"\1location ^~ /me/ {",
-                    block,
-                    flags=re.MULTILINE,
-                )
+                cloned = RE_LOC_ME_EXACT.sub(r"\g<indent>location ^~ /me/ {", block)
                 insertion = "\n" + indent + f"{MARKER}: api proxy (/me/*)\n" + cloned + "\n"
                 server_block = server_block[:end] + insertion + server_block[end:]
+                present.add("me_prefix")
                 changed = True
 
     # Ensure at least the minimal `location = /me` exists (for setups that don't have it).
-    server_block, c2 = _ensure_location_if_missing(
-        server_block,
-        location_header_regex=r"(^\s*location\s+=\s*/me\s*\{)",
-        location_block=(
-            f"    {MARKER}: api proxy\n"
-            "    location = /me {\n"
-            f"        proxy_pass {upstream};\n"
-            f"{_proxy_common_headers()}"
-            "    }\n"
-        ),
-    )
-    changed = changed or c2
+    if "me_exact" not in present:
+        server_block, c2 = _insert_location_block(
+            server_block,
+            (
+                f"    {MARKER}: api proxy\n"
+                "    location = /me {\n"
+                f"        proxy_pass {upstream};\n"
+                f"{_proxy_common_headers()}"
+                "    }\n"
+            ),
+        )
+        changed = changed or c2
 
     # And ensure /me/ exists (fallback minimal block if we couldn't clone).
-    server_block, c3 = _ensure_location_if_missing(
-        server_block,
-        location_header_regex=r"(^\s*location\s+\^~\s+/me/\s*\{)",
-        location_block=(
-            f"    {MARKER}: api proxy\n"
-            "    location ^~ /me/ {\n"
-            f"        proxy_pass {upstream};\n"
-            f"{_proxy_common_headers()}"
-            "    }\n"
-        ),
-    )
-    changed = changed or c3
+    if "me_prefix" not in present:
+        server_block, c3 = _insert_location_block(
+            server_block,
+            (
+                f"    {MARKER}: api proxy\n"
+                "    location ^~ /me/ {\n"
+                f"        proxy_pass {upstream};\n"
+                f"{_proxy_common_headers()}"
+                "    }\n"
+            ),
+        )
+        changed = changed or c3
 
     # Common backend namespaces.
-    for prefix in ("auth", "webhooks", "public", "submissions", "channels", "wallet", "memes", "streamer", "owner", "moderation"):
-        # wallet/memes are without trailing slash in some clients; use both exact and prefix where relevant.
-        if prefix in ("wallet", "memes"):
-            server_block, cx = _ensure_location_if_missing(
+    for prefix in API_PREFIXES:
+        if prefix in API_EXACT_PREFIXES and f"= /{prefix}" not in present:
+            server_block, cx = _insert_location_block(
                 server_block,
-                location_header_regex=rf"(^\s*location\s+=\s*/{re.escape(prefix)}\s*\{{)",
-                location_block=(
+                (
                     f"    {MARKER}: api proxy\n"
                     f"    location = /{prefix} {{\n"
                     f"        proxy_pass {upstream};\n"
@@ -469,122 +500,133 @@ def _ensure_memalerts_api_proxy_locations(server_block: str, *, upstream_port: i
             )
             changed = changed or cx
 
-        server_block, cy = _ensure_location_if_missing(
+        if f"^~ /{prefix}/" not in present:
+            server_block, cy = _insert_location_block(
+                server_block,
+                (
+                    f"    {MARKER}: api proxy\n"
+                    f"    location ^~ /{prefix}/ {{\n"
+                    f"        proxy_pass {upstream};\n"
+                    f"{_proxy_common_headers()}"
+                    "    }\n"
+                ),
+            )
+            changed = changed or cy
+
+    # Socket.IO (WebSocket upgrade).
+    if "socket_io" not in present:
+        server_block, c8 = _insert_location_block(
             server_block,
-            location_header_regex=rf"(^\s*location\s+\^~\s+/{re.escape(prefix)}/\s*\{{)",
-            location_block=(
-                f"    {MARKER}: api proxy\n"
-                f"    location ^~ /{prefix}/ {{\n"
+            (
+                f"    {MARKER}: socket.io proxy\n"
+                "    location /socket.io/ {\n"
                 f"        proxy_pass {upstream};\n"
                 f"{_proxy_common_headers()}"
+                "        proxy_http_version 1.1;\n"
+                "        proxy_set_header Upgrade $http_upgrade;\n"
+                '        proxy_set_header Connection "upgrade";\n'
+                "        proxy_read_timeout 3600s;\n"
+                "        proxy_send_timeout 3600s;\n"
                 "    }\n"
             ),
         )
-        changed = changed or cy
-
-    # Socket.IO (WebSocket upgrade).
-    server_block, c8 = _ensure_location_if_missing(
-        server_block,
-        location_header_regex=r"(^\s*location\s+/socket\.io/\s*\{)",
-        location_block=(
-            f"    {MARKER}: socket.io proxy\n"
-            "    location /socket.io/ {\n"
-            f"        proxy_pass {upstream};\n"
-            f"{_proxy_common_headers()}"
-            "        proxy_http_version 1.1;\n"
-            "        proxy_set_header Upgrade $http_upgrade;\n"
-            '        proxy_set_header Connection "upgrade";\n'
-            "        proxy_read_timeout 3600s;\n"
-            "        proxy_send_timeout 3600s;\n"
-            "    }\n"
-        ),
-    )
-    changed = changed or c8
+        changed = changed or c8
 
     # Optional: /api/* compatibility (strip /api prefix by using trailing slash in proxy_pass).
-    server_block, c9 = _ensure_location_if_missing(
-        server_block,
-        location_header_regex=r"(^\s*location\s+\^~\s+/api/\s*\{)",
-        location_block=(
-            f"    {MARKER}: api compat (/api/* -> /*)\n"
-            "    location ^~ /api/ {\n"
-            f"        proxy_pass {upstream}/;\n"
-            f"{_proxy_common_headers()}"
-            "    }\n"
-        ),
-    )
-    changed = changed or c9
+    if "api" not in present:
+        server_block, c9 = _insert_location_block(
+            server_block,
+            (
+                f"    {MARKER}: api compat (/api/* -> /*)\n"
+                "    location ^~ /api/ {\n"
+                f"        proxy_pass {upstream}/;\n"
+                f"{_proxy_common_headers()}"
+                "    }\n"
+            ),
+        )
+        changed = changed or c9
 
     return (server_block, changed)
 
 
-def _ensure_location_rate_limit(
-    server_block: str,
-    *,
-    location_prefix_regex: str,
-    zone: str,
-    burst: int,
-) -> tuple[str, bool]:
+def _ensure_location_rate_limits(server_block: str) -> tuple[str, bool]:
     """
-    Adds `limit_req zone=...` inside matching location block(s) if not present.
-    We patch only if location exists and doesn't already have `limit_req`.
+    Adds `limit_req zone=...` inside every location listed in RATE_LIMITS that doesn't have one yet.
+    All rate-limited locations are found in a single pass and patched with a single join.
     """
-    changed = False
-    loc_header_re = re.compile(rf"(^\s*location\s+{location_prefix_regex}\s*\{{)", flags=re.MULTILINE)
-    for m in list(loc_header_re.finditer(server_block)):
-        start = m.start(1)
-        brace_open = server_block.find("{", start)
-        if brace_open == -1:
+    parts: list[str] = []
+    cursor = 0
+    for m in _RE_RATE_LIMITED_LOC.finditer(server_block):
+        brace_open = m.end() - 1
+        loc_end = find_block_end(server_block, brace_open)
+        if loc_end == -1:
             continue
-        j = brace_open + 1
-        depth = 1
-        while j < len(server_block):
-            ch = server_block[j]
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    loc_end = j + 1
-                    loc_block = server_block[start:loc_end]
-                    if "limit_req " in loc_block:
-                        break
-                    insertion = f"        {MARKER}: rate-limit\n        limit_req zone={zone} burst={burst} nodelay;\n"
-                    # Insert right after opening brace line
-                    brace_line_end = server_block.find("\n", brace_open)
-                    if brace_line_end == -1:
-                        break
-                    server_block = server_block[: brace_line_end + 1] + insertion + server_block[brace_line_end + 1 :]
-                    changed = True
-                    break
-            j += 1
-    return (server_block, changed)
+        if server_block.find("limit_req ", m.start(), loc_end) != -1:
+            continue
+        # Insert right after opening brace line
+        brace_line_end = server_block.find("\n", brace_open)
+        if brace_line_end == -1:
+            continue
+        _, zone, burst = RATE_LIMITS[m.lastgroup]
+        parts.append(server_block[cursor : brace_line_end + 1])
+        parts.append(f"        {MARKER}: rate-limit\n        limit_req zone={zone} burst={burst} nodelay;\n")
+        cursor = brace_line_end + 1
+    if not parts:
+        return (server_block, False)
+    parts.append(server_block[cursor:])
+    return ("".join(parts), True)
 
 
-def patch_nginx_site_file(
+@functools.lru_cache(maxsize=None)
+def _domain_needles(domains: frozenset[str]) -> tuple[bytes, ...]:
+    """
+    Encoded substrings that tell whether a file can mention any of `domains`.
+    A file containing www.<d> or beta.<d> also contains <d>, so names that contain
+    another name are dropped: prod + www + beta usually collapse to a single search.
+    """
+    needles: list[bytes] = []
+    for d in sorted({d.encode("utf-8") for d in domains}, key=len):
+        if not any(n in d for n in needles):
+            needles.append(d)
+    return tuple(needles)
+
+
+def plan_nginx_site_file(
     path: Path,
     *,
     match_domains: set[str],
     uploads_alias_by_domain: dict[str, str],
     backend_port_by_domain: dict[str, int],
-    dry_run: bool,
-) -> PatchResult:
-    text = _read_text(path)
-    blocks = _server_blocks(text)
+) -> tuple[PatchResult, Optional[str]]:
+    """
+    Reads and patches one vhost in memory. Returns (result, new_text); new_text is None if the file stays as is.
+    Nothing is written here, so every file can be checked before any of them is touched.
+    """
+    raw = _read_bytes(path)
+    # Most vhosts on the box are unrelated: check the raw bytes for our domains
+    # and only decode and parse files that mention one of them.
+    if not any(n in raw for n in _domain_needles(frozenset(match_domains))):
+        return (PatchResult(changed=False, details=[f"keep {path}"]), None)
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError as e:
+        _die(f"Not valid UTF-8: {path} ({e})")
+    blocks = server_blocks(text)
     if not blocks:
-        return PatchResult(changed=False, details=[f"skip (no server blocks): {path}"])
+        return (PatchResult(changed=False, details=[f"skip (no server blocks): {path}"]), None)
 
     changed = False
     details: list[str] = []
 
-    new_text = text
-    # Iterate from end to start so indices remain valid while replacing.
-    for start, end in reversed(blocks):
-        server_block = new_text[start:end]
-        names = set(_server_names(server_block))
+    # Walk blocks left to right, collecting untouched spans and patched blocks; join once at the end.
+    parts: list[str] = []
+    cursor = 0
+    for start, end in blocks:
+        names = set(_server_names(text, start, end))
         matched = (names & match_domains)
         if not matched:
             continue
+        server_block = text[start:end]
 
         # Pick uploads alias dir based on which domain matched this server block.
         # Prefer an explicit mapping; otherwise keep the first matched domain.
@@ -613,42 +655,24 @@ def patch_nginx_site_file(
             c1 = False
 
         patched, c_api = _ensure_memalerts_api_proxy_locations(patched, upstream_port=upstream_port)
-        patched, c2 = _ensure_location_rate_limit(
-            patched,
-            location_prefix_regex=r"=" + r"\s*/me",  # exact match
-            zone="memalerts_api_per_ip",
-            burst=30,
-        )
-        patched, c3 = _ensure_location_rate_limit(
-            patched,
-            location_prefix_regex=r"\^~\s+/auth/",
-            zone="memalerts_auth_per_ip",
-            burst=10,
-        )
-        patched, c4 = _ensure_location_rate_limit(
-            patched,
-            location_prefix_regex=r"/socket\.io/",
-            zone="memalerts_api_per_ip",
-            burst=60,
-        )
-        patched, c5 = _ensure_location_rate_limit(
-            patched,
-            location_prefix_regex=r"/",
-            zone="memalerts_api_per_ip",
-            burst=80,
-        )
+        patched, c_rl = _ensure_location_rate_limits(patched)
 
-        if any([c1, c_api, c2, c3, c4, c5]):
-            new_text = new_text[:start] + patched + new_text[end:]
+        if c1 or c_api or c_rl:
+            parts.append(text[cursor:start])
+            parts.append(patched)
+            cursor = end
             changed = True
             details.append(f"patch vhost: {path} (server_name: {' '.join(sorted(matched))})")
 
     if not changed:
-        return PatchResult(changed=False, details=[f"keep {path}"])
+        return (PatchResult(changed=False, details=[f"keep {path}"]), None)
 
-    _backup_file(path, dry_run=dry_run)
-    _write_text(path, new_text, dry_run=dry_run)
-    return PatchResult(changed=True, details=details)
+    parts.append(text[cursor:])
+    new_text = "".join(parts)
+    # Nothing to back up or rewrite if the patchers ended up reproducing the file byte for byte.
+    if new_text == text:
+        return (PatchResult(changed=False, details=[f"keep {path}"]), None)
+    return (PatchResult(changed=True, details=details), new_text)
 
 
 def ensure_fail2ban_req_limit(*, dry_run: bool) -> PatchResult:
@@ -706,6 +730,12 @@ def main() -> None:
     )
     parser.add_argument("--dry-run", action="store_true", help="Do not write changes; just print actions.")
     parser.add_argument("--with-fail2ban", action="store_true", help="Also create fail2ban jail/filter (if missing).")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Vhost files to read and patch concurrently before writing (default: 1)",
+    )
 
     args = parser.parse_args()
 
@@ -734,6 +764,9 @@ def main() -> None:
     except Exception:
         _die(f"Invalid --beta-backend-port: {args.beta_backend_port}")
 
+    if args.jobs < 1:
+        _die(f"Invalid --jobs: {args.jobs}")
+
     backend_port_by_domain = {
         prod_domain: prod_port,
         f"www.{prod_domain}": prod_port,
@@ -746,18 +779,29 @@ def main() -> None:
     results.append(ensure_rate_limit_zones_conf(dry_run=args.dry_run))
 
     # Patch vhosts. We patch any file that contains matching server_name(s).
+    # Plan every file first and write only once all of them succeeded: a bad file must stop
+    # the run before any live vhost is touched. Planning is regex work on small files,
+    # so it only runs on a thread pool if --jobs asks for it; map() keeps scan order either way.
+    plan_one = functools.partial(
+        plan_nginx_site_file,
+        match_domains=match_domains,
+        uploads_alias_by_domain=uploads_alias_by_domain,
+        backend_port_by_domain=backend_port_by_domain,
+    )
+    site_files = list(_iter_nginx_site_files())
+    if args.jobs == 1:
+        plans = list(map(plan_one, site_files))
+    else:
+        with ThreadPoolExecutor(max_workers=args.jobs) as ex:
+            plans = list(ex.map(plan_one, site_files))
+
     any_vhost_patched = False
-    for site_file in _iter_nginx_site_files():
-        r = patch_nginx_site_file(
-            site_file,
-            match_domains=match_domains,
-            uploads_alias_by_domain=uploads_alias_by_domain,
-            backend_port_by_domain=backend_port_by_domain,
-            dry_run=args.dry_run,
-        )
-        results.append(r)
-        if r.changed:
+    for path, (r, new_text) in zip(site_files, plans):
+        if new_text is not None:
+            _backup_file(path, dry_run=args.dry_run)
+            _write_text(path, new_text, dry_run=args.dry_run)
             any_vhost_patched = True
+        results.append(r)
 
     if beta_domain and args.beta_backend_dir:
         # If beta vhost exists and matches beta domain, it should have been patched above.
@@ -14,6 +14,8 @@ from __future__ import annotations
 import re
 from pathlib import Path
 
+from _nginx_blocks import extract_braced_block, file_contains
+
 TARGET = Path("/etc/nginx/sites-available/memalerts")
 if not TARGET.exists():
     TARGET = Path("/etc/nginx/sites-enabled/memalerts")
@@ -21,58 +23,57 @@ if not TARGET.exists():
 ME_MARKER = "# memalerts-managed: proxy /me/* (fix SPA HTML)"
 API_MARKER = "# memalerts-managed: compat /api/* -> /*"
 
+_RE_MARKERS = re.compile(f"(?P<me>{re.escape(ME_MARKER)})|(?P<api>{re.escape(API_MARKER)})")
+_RE_LOC_ME_PREFIX = re.compile(r"^\s*location\s+\^~\s+/me/\s*\{", flags=re.MULTILINE)
+# Everything the /me/ -> /api/ clone rewrites: the location header and the upstream proxy_pass.
+_RE_ME_CLONE = re.compile(
+    r"^(?P<indent>\s*)location\s+\^~\s+/me/\s*\{|proxy_pass\s+http://localhost:3002\s*;",
+    flags=re.MULTILINE,
+)
+
 
-def extract_braced_block(s: str, start_idx: int) -> tuple[str, int]:
-    brace_open = s.find("{", start_idx)
-    if brace_open == -1:
-        return ("", -1)
-    i = brace_open + 1
-    depth = 1
-    while i < len(s):
-        ch = s[i]
-        if ch == "{":
-            depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                return (s[start_idx:end], end)
-        i += 1
-    return ("", -1)
+def _me_to_api(m: re.Match[str]) -> str:
+    if m["indent"] is None:
+        # Ensure /api prefix stripping
+        return "proxy_pass http://localhost:3002/;"
+    return f"{m['indent']}{API_MARKER}\n{m['indent']}location ^~ /api/ {{"
 
 
 def main() -> int:
+    if not file_contains(TARGET, ME_MARKER.encode("utf-8")):
+        raise SystemExit(f"ERROR: marker not found: {ME_MARKER}")
+
     text = TARGET.read_text(encoding="utf-8")
     orig = text
 
-    marker_idx = text.rfind(ME_MARKER)
+    # One forward pass: remember the last /me marker and whether an /api marker follows it.
+    marker_idx = -1
+    api_after = False
+    for m in _RE_MARKERS.finditer(text):
+        if m.lastgroup == "me":
+            marker_idx = m.start()
+            api_after = False
+        elif marker_idx != -1:
+            api_after = True
     if marker_idx == -1:
         raise SystemExit(f"ERROR: marker not found: {ME_MARKER}")
 
     # If API marker already appears after the last /me marker, treat as already patched.
-    if text.find(API_MARKER, marker_idx) != -1:
+    if api_after:
         print("NOOP: /api compat already present after beta /me marker")
         return 0
 
-    m_loc = re.search(r"^\s*location\s+\^~\s+/me/\s*\{", text[marker_idx:], flags=re.MULTILINE)
+    m_loc = _RE_LOC_ME_PREFIX.search(text, marker_idx)
     if not m_loc:
         raise SystemExit("ERROR: could not find `location ^~ /me/ {` after marker")
 
-    loc_start = marker_idx + m_loc.start(0)
+    loc_start = m_loc.start(0)
     me_block, me_end = extract_braced_block(text, loc_start)
     if not me_block or me_end == -1:
         raise SystemExit("ERROR: failed to parse /me/ block braces")
 
-    # Clone /me/ -> /api/
-    api_block = re.sub(
-        r"^(\s*)location\s+\^~\s+/me/\s*\{",
-        r"\1" + API_MARKER + r"\n\1location ^~ /api/ {",
-        me_block,
-        flags=re.MULTILINE,
-        count=1,
-    )
-    # Ensure /api prefix stripping
-    api_block = re.sub(r"proxy_pass\s+http://localhost:3002\s*;", "proxy_pass http://localhost:3002/;", api_block)
+    # Clone /me/ -> /api/ in a single substitution pass.
+    api_block = _RE_ME_CLONE.sub(_me_to_api, me_block)
 
     insertion = "\n" + api_block + "\n"
     text = text[:me_end] + insertion + text[me_end:]
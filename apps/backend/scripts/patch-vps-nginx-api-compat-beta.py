@@ -19,71 +19,38 @@ from __future__ import annotations
 import re
 from pathlib import Path
 
+from _nginx_blocks import extract_braced_block, file_contains, server_blocks
+
 TARGET = Path("/etc/nginx/sites-available/memalerts")
 if not TARGET.exists():
     TARGET = Path("/etc/nginx/sites-enabled/memalerts")
 
+BETA_SERVER_NAME = "server_name beta.twitchmemes.ru;"
 
-def server_blocks(text: str) -> list[tuple[int, int]]:
-    blocks: list[tuple[int, int]] = []
-    i = 0
-    n = len(text)
-    while i < n:
-        m = re.search(r"\bserver\s*\{", text[i:])
-        if not m:
-            break
-        start = i + m.start()
-        j = start + m.end() - m.start()
-        depth = 0
-        while j < n:
-            ch = text[j]
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    end = j + 1
-                    blocks.append((start, end))
-                    i = end
-                    break
-            j += 1
-        else:
-            break
-    return blocks
-
-
-def extract_braced_block(s: str, start_idx: int) -> tuple[str, int]:
-    brace_open = s.find("{", start_idx)
-    if brace_open == -1:
-        return ("", -1)
-    i = brace_open + 1
-    depth = 1
-    while i < len(s):
-        ch = s[i]
-        if ch == "{":
-            depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                return (s[start_idx:end], end)
-        i += 1
-    return ("", -1)
+_RE_LISTEN_443_SSL = re.compile(r"^\s*listen\s+443\b.*\bssl\b", flags=re.MULTILINE)
+_RE_LOC_API = re.compile(r"^\s*location\s+\^~\s+/api/\s*\{", flags=re.MULTILINE)
+_RE_LOC_HEADER = re.compile(r"^(?P<indent>\s*)location\s+[^\{]+\{", flags=re.MULTILINE)
+_RE_PROXY_PASS_BETA = re.compile(r"proxy_pass\s+http://localhost:3002\s*;")
 
 
 def main() -> int:
+    # No beta vhost in the file: nothing to do, and no need to read it in.
+    if not file_contains(TARGET, BETA_SERVER_NAME.encode("utf-8")):
+        print("NOOP: nothing to change")
+        return 0
+
     text = TARGET.read_text(encoding="utf-8")
     orig = text
     changed = False
 
     for start, end in reversed(server_blocks(text)):
         sb = text[start:end]
-        if "server_name beta.twitchmemes.ru;" not in sb:
+        if BETA_SERVER_NAME not in sb:
             continue
-        if not re.search(r"^\s*listen\s+443\b.*\bssl\b", sb, flags=re.MULTILINE):
+        if not _RE_LISTEN_443_SSL.search(sb):
             continue
 
-        if re.search(r"^\s*location\s+\^~\s+/api/\s*\{", sb, flags=re.MULTILINE):
+        if _RE_LOC_API.search(sb):
             continue
 
         # Prefer cloning headers from our already-inserted /me/ proxy block (marked).
@@ -94,7 +61,7 @@ def main() -> int:
             raise SystemExit("ERROR: beta SSL server block missing /me/* marker; run the /me proxy patch first")
 
         # Find the next `location ... {` header after the marker.
-        m_me = re.search(r"^(?P<indent>\s*)location\s+[^\{]+\{", sb[marker_idx:], flags=re.MULTILINE)
+        m_me = _RE_LOC_HEADER.search(sb[marker_idx:])
         if not m_me:
             raise SystemExit("ERROR: could not find a location block after the /me/* marker")
         indent = m_me.group("indent")
@@ -107,14 +74,10 @@ def main() -> int:
         api_block = (
             indent
             + "# memalerts-managed: compat /api/* -> /*\n"
-            + re.sub(r"^(?P<ind>\s*)location\s+[^\{]+\{", r"\g<ind>location ^~ /api/ {", me_block, flags=re.MULTILINE, count=1)
+            + _RE_LOC_HEADER.sub(r"\g<indent>location ^~ /api/ {", me_block, count=1)
         )
         # Ensure proxy_pass strips /api prefix
-        api_block = re.sub(
-            r"proxy_pass\s+http://localhost:3002\s*;",
-            "proxy_pass http://localhost:3002/;",
-            api_block,
-        )
+        api_block = _RE_PROXY_PASS_BETA.sub("proxy_pass http://localhost:3002/;", api_block)
 
         insertion = "\n" + api_block + "\n"
         sb = sb[:me_end] + insertion + sb[me_end:]
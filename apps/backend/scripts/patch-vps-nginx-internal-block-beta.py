@@ -20,56 +20,41 @@ from __future__ import annotations
 import re
 from pathlib import Path
 
+from _nginx_blocks import file_contains, server_blocks
+
 TARGET = Path("/etc/nginx/sites-available/memalerts")
 if not TARGET.exists():
     TARGET = Path("/etc/nginx/sites-enabled/memalerts")
 
+BETA_SERVER_NAME = "server_name beta.twitchmemes.ru;"
 
-def server_blocks(text: str) -> list[tuple[int, int]]:
-    blocks: list[tuple[int, int]] = []
-    i = 0
-    n = len(text)
-    while i < n:
-        m = re.search(r"\bserver\s*\{", text[i:])
-        if not m:
-            break
-        start = i + m.start()
-        j = start + m.end() - m.start()
-        depth = 0
-        while j < n:
-            ch = text[j]
-            if ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    end = j + 1
-                    blocks.append((start, end))
-                    i = end
-                    break
-            j += 1
-        else:
-            break
-    return blocks
+_RE_LISTEN_443_SSL = re.compile(r"^\s*listen\s+443\b.*\bssl\b", flags=re.MULTILINE)
+_RE_LOC_INTERNAL = re.compile(r"^\s*location\s+\^~\s+/internal/\s*\{", flags=re.MULTILINE)
+_RE_SERVER_NAME_BETA = re.compile(r"^\s*server_name\s+beta\.twitchmemes\.ru\s*;\s*$", flags=re.MULTILINE)
 
 
 def main() -> int:
+    # No beta vhost in the file: nothing to do, and no need to read it in.
+    if not file_contains(TARGET, BETA_SERVER_NAME.encode("utf-8")):
+        print("NOOP: nothing to change")
+        return 0
+
     text = TARGET.read_text(encoding="utf-8")
     orig = text
     changed = False
 
     for start, end in reversed(server_blocks(text)):
         sb = text[start:end]
-        if "server_name beta.twitchmemes.ru;" not in sb:
+        if BETA_SERVER_NAME not in sb:
             continue
-        if not re.search(r"^\s*listen\s+443\b.*\bssl\b", sb, flags=re.MULTILINE):
+        if not _RE_LISTEN_443_SSL.search(sb):
             continue
 
-        if re.search(r"^\s*location\s+\^~\s+/internal/\s*\{", sb, flags=re.MULTILINE):
+        if _RE_LOC_INTERNAL.search(sb):
             continue
 
         # Robust insertion: right after `server_name beta.twitchmemes.ru;` line inside this server block.
-        m_sn = re.search(r"^\s*server_name\s+beta\.twitchmemes\.ru\s*;\s*$", sb, flags=re.MULTILINE)
+        m_sn = _RE_SERVER_NAME_BETA.search(sb)
         if not m_sn:
             raise SystemExit("ERROR: could not find server_name line inside beta SSL server block")
         line_end = sb.find("\n", m_sn.end(0))
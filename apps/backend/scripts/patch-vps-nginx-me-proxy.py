@@ -21,174 +21,195 @@ It will (idempotent):
 from __future__ import annotations
 
 import re
+import shutil
+import textwrap
 from pathlib import Path
 
+from _nginx_blocks import (
+    RE_LOC_ME_EXACT,
+    enclosing_server_block,
+    extract_braced_block,
+    mapped_file,
+    next_server_start,
+    write_atomic,
+)
+
 # The current VPS source-of-truth vhost file (see docs/VPS_STRUCTURE.md).
 # Note: /etc/nginx/sites-enabled/memalerts is usually a symlink to sites-available.
 TARGET = Path("/etc/nginx/sites-available/memalerts")
 if not TARGET.exists():
     TARGET = Path("/etc/nginx/sites-enabled/memalerts")
 
+ME_MARKER = "# memalerts-managed: proxy /me/* (fix SPA HTML)"
+BETA_SERVER_NAME = "server_name beta.twitchmemes.ru;"
+
+_RE_LOC_ME_PREFIX = re.compile(r"^\s*location\s+\^~\s+/me/\s*\{", flags=re.MULTILINE)
+# Same header as bytes, for probing the mmapped file before it is read.
+_RE_LOC_ME_PREFIX_BYTES = re.compile(_RE_LOC_ME_PREFIX.pattern.encode("utf-8"), flags=re.MULTILINE)
+# Guard locations step 2 ensures in beta servers; one finditer collects the ones already present.
+_RE_LOC_BETA_GUARDS = re.compile(r"^\s*location\s+\^~\s+/(?P<path>internal|api)/\s*\{", flags=re.MULTILINE)
+
+# Blocks inserted into beta servers; indented to match the server's locations with textwrap.indent.
+_INTERNAL_BLOCK_TMPL = (
+    "# memalerts-managed: block internal relay\n"
+    "location ^~ /internal/ {\n"
+    "    return 404;\n"
+    "}\n"
+)
+_API_BLOCK_TMPL = (
+    "# memalerts-managed: compat /api/* -> /*\n"
+    "location ^~ /api/ {\n"
+    "    proxy_pass http://localhost:3002/;\n"
+    "    proxy_http_version 1.1;\n"
+    "    proxy_set_header Host $host;\n"
+    "    proxy_set_header X-Real-IP $remote_addr;\n"
+    "    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n"
+    "    proxy_set_header X-Forwarded-Proto $scheme;\n"
+    "    proxy_set_header CF-Connecting-IP $http_cf_connecting_ip;\n"
+    "    proxy_set_header Cookie $http_cookie;\n"
+    "    proxy_cache_bypass $http_upgrade;\n"
+    "    proxy_pass_header Set-Cookie;\n"
+    "    proxy_cookie_path / /;\n"
+    "}\n"
+)
+
+
+def is_noop(path: Path) -> bool:
+    """
+    True if /me/* is already proxied and there is no beta vhost for step 2 to check.
+    Probes an mmap of the file, so a re-run that changes nothing never reads or decodes it.
+    """
+    with mapped_file(path) as mm:
+        return (
+            mm is not None
+            and mm.find(BETA_SERVER_NAME.encode("utf-8")) == -1
+            and _RE_LOC_ME_PREFIX_BYTES.search(mm) is not None
+        )
 
-def find_block_ends_for_location_me(text: str) -> list[tuple[int, int, str]]:
+
+def find_block_ends_for_location_me(text: str) -> list[tuple[int, int, str, str, str]]:
     """
-    Returns [(start_idx, end_idx, indent)] for each `location = /me { ... }` block.
+    Returns [(start_idx, end_idx, indent, header, block)] for each `location = /me { ... }` block.
+    `header` is the matched header text as written (including indent), so callers can replace it literally.
     """
-    out: list[tuple[int, int, str]] = []
-    for m in re.finditer(r"^(?P<indent>\s*)location\s*=\s*/me\s*\{", text, flags=re.MULTILINE):
+    out: list[tuple[int, int, str, str, str]] = []
+    # Bound each brace search by the next server header, so an unclosed block can't drag it to EOF.
+    # The header is only looked up again once a match has moved past it.
+    stop = next_server_start(text, 0)
+    for m in RE_LOC_ME_EXACT.finditer(text):
         start = m.start(0)
+        while stop is not None and stop < start:
+            stop = next_server_start(text, stop + 1)
         indent = m.group("indent")
-        block, end = extract_braced_block(text, start)
+        block, end = extract_braced_block(text, start, stop)
         if not block or end == -1:
             continue
-        out.append((start, end, indent))
+        out.append((start, end, indent, m.group(0), block))
     return out
 
 
-def extract_braced_block(s: str, start_idx: int) -> tuple[str, int]:
-    brace_open = s.find("{", start_idx)
-    if brace_open == -1:
-        return ("", -1)
-    i = brace_open + 1
-    depth = 1
-    while i < len(s):
-        ch = s[i]
-        if ch == "{":
-            depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0:
-                end = i + 1
-                return (s[start_idx:end], end)
-        i += 1
-    return ("", -1)
-
-
-def ensure_block_before_location_slash(server_block: str, block: str) -> tuple[str, bool]:
+def apply_edits(text: str, edits: list[tuple[int, int, str]]) -> str:
     """
-    Insert `block` before `location / {` if present, else before final `}`.
+    Returns text with each (start, end, replacement) applied; an insertion has start == end.
+    Edits must be in file order and must not overlap; both callers produce them in a forward scan.
+    The result is assembled with a single join.
+    """
+    parts: list[str] = []
+    cursor = 0
+    for start, end, replacement in edits:
+        parts.append(text[cursor:start])
+        parts.append(replacement)
+        cursor = end
+    parts.append(text[cursor:])
+    return "".join(parts)
+
+
+def find_insert_point(server_block: str) -> int:
+    """
+    Returns the index to insert blocks at: before `location / {` if present, else before final `}`.
+    Returns -1 if neither is found.
     """
     insert_point = server_block.find("\n    location / {")
     if insert_point == -1:
         insert_point = server_block.rfind("\n}")
-    if insert_point == -1:
-        return (server_block, False)
-    if not block.startswith("\n"):
-        block = "\n" + block
-    if not block.endswith("\n"):
-        block = block + "\n"
-    return (server_block[:insert_point] + block + server_block[insert_point:], True)
+    return insert_point
 
 
 def main() -> int:
+    # Fast NOOP for re-runs: /me/* is in place and there is no beta vhost for step 2 to check.
+    # Managed markers alone can't prove step 2 is done: other patchers write the same
+    # "block internal relay" marker into prod server blocks.
+    if is_noop(TARGET):
+        print("NOOP: nothing to change")
+        return 0
+
     text = TARGET.read_text(encoding="utf-8")
     orig = text
 
-    changed_any = False
-
     # 1) Ensure /me/* exists by cloning location = /me blocks (common pattern in this vhost).
-    if not re.search(r"^\s*location\s+\^~\s+/me/\s*\{", text, flags=re.MULTILINE):
+    # The header can only match where the literal path occurs: a substring check skips the regex when it's absent.
+    if not ("/me/" in text and _RE_LOC_ME_PREFIX.search(text)):
         blocks = find_block_ends_for_location_me(text)
         if not blocks:
             raise SystemExit("ERROR: no `location = /me {` blocks found to clone")
 
-        # Insert after each `location = /me` block (iterate from end to keep indices stable).
-        for start, end, indent in reversed(blocks):
-            block, _end2 = extract_braced_block(text, start)
-            if not block:
-                continue
-            cloned = re.sub(
-                r"^(\s*)location\s*=\s*/me\s*\{",
-                r"\1location ^~ /me/ {",
-                block,
-                flags=re.MULTILINE,
-            )
-            insertion = "\n" + indent + "# memalerts-managed: proxy /me/* (fix SPA HTML)\n" + cloned + "\n"
-            text = text[:end] + insertion + text[end:]
-            changed_any = True
+        # Insert after each `location = /me` block.
+        clones: list[tuple[int, int, str]] = []
+        for start, end, indent, header, block in blocks:
+            cloned = block.replace(header, f"{indent}location ^~ /me/ {{", 1)
+            insertion = "\n" + indent + ME_MARKER + "\n" + cloned + "\n"
+            clones.append((end, end, insertion))
+        text = apply_edits(text, clones)
 
     # 2) Ensure beta server blocks have /internal blocked and /api compat.
     # We patch only blocks containing `server_name beta.twitchmemes.ru;`.
     # Insert before `location / {` if present to avoid SPA fallback catching these paths.
-    def _server_blocks(s: str) -> list[tuple[int, int]]:
-        blocks: list[tuple[int, int]] = []
-        i = 0
-        n = len(s)
-        while i < n:
-            m = re.search(r"\bserver\s*\{", s[i:])
-            if not m:
-                break
-            start = i + m.start()
-            j = start + m.end() - m.start()
-            depth = 0
-            while j < n:
-                ch = s[j]
-                if ch == "{":
-                    depth += 1
-                elif ch == "}":
-                    depth -= 1
-                    if depth == 0:
-                        end = j + 1
-                        blocks.append((start, end))
-                        i = end
-                        break
-                j += 1
-            else:
-                break
-        return blocks
-
-    for start, end in reversed(_server_blocks(text)):
+    # Find the beta server_name lines first and brace-match only the server blocks around them.
+    # Use indentation of existing locations; the vhosts in one file share it, so sample it once.
+    m_indent = RE_LOC_ME_EXACT.search(text)
+    indent = m_indent.group("indent") if m_indent else "    "
+
+    beta_edits: list[tuple[int, int, str]] = []
+    pos = 0
+    while True:
+        hit = text.find(BETA_SERVER_NAME, pos)
+        if hit == -1:
+            break
+        span = enclosing_server_block(text, hit)
+        if span is None:
+            pos = hit + len(BETA_SERVER_NAME)
+            continue
+        start, end = span
+        pos = end
         sb = text[start:end]
-        if "server_name beta.twitchmemes.ru;" not in sb:
+
+        present = {m["path"] for m in _RE_LOC_BETA_GUARDS.finditer(sb)}
+        if "internal" in present and "api" in present:
             continue
+        # Both blocks go in at the same point, one after the other; find it once per server.
+        insert_point = find_insert_point(sb)
+        if insert_point == -1:
+            continue
+
+        insertion = ""
+        if "internal" not in present:
+            insertion += "\n" + textwrap.indent(_INTERNAL_BLOCK_TMPL, indent)
+        if "api" not in present:
+            insertion += "\n" + textwrap.indent(_API_BLOCK_TMPL, indent)
+        beta_edits.append((start + insert_point, start + insert_point, insertion))
+    text = apply_edits(text, beta_edits)
 
-        # Use indentation of existing locations in this server.
-        m_indent = re.search(r"^(?P<indent>\s*)location\s*=\s*/me\s*\{", sb, flags=re.MULTILINE)
-        indent = m_indent.group("indent") if m_indent else "    "
-
-        inserted_any = False
-
-        if not re.search(r"^\s*location\s+\^~\s+/internal/\s*\{", sb, flags=re.MULTILINE):
-            sb, c = ensure_block_before_location_slash(
-                sb,
-                f"{indent}# memalerts-managed: block internal relay\n"
-                f"{indent}location ^~ /internal/ {{\n"
-                f"{indent}    return 404;\n"
-                f"{indent}}}\n",
-            )
-            inserted_any = inserted_any or c
-
-        if not re.search(r"^\s*location\s+\^~\s+/api/\s*\{", sb, flags=re.MULTILINE):
-            sb, c = ensure_block_before_location_slash(
-                sb,
-                f"{indent}# memalerts-managed: compat /api/* -> /*\n"
-                f"{indent}location ^~ /api/ {{\n"
-                f"{indent}    proxy_pass http://localhost:3002/;\n"
-                f"{indent}    proxy_http_version 1.1;\n"
-                f"{indent}    proxy_set_header Host $host;\n"
-                f"{indent}    proxy_set_header X-Real-IP $remote_addr;\n"
-                f"{indent}    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n"
-                f"{indent}    proxy_set_header X-Forwarded-Proto $scheme;\n"
-                f"{indent}    proxy_set_header CF-Connecting-IP $http_cf_connecting_ip;\n"
-                f"{indent}    proxy_set_header Cookie $http_cookie;\n"
-                f"{indent}    proxy_cache_bypass $http_upgrade;\n"
-                f"{indent}    proxy_pass_header Set-Cookie;\n"
-                f"{indent}    proxy_cookie_path / /;\n"
-                f"{indent}}}\n",
-            )
-            inserted_any = inserted_any or c
-
-        if inserted_any:
-            text = text[:start] + sb + text[end:]
-            changed_any = True
-
-    if not changed_any:
+    # Compare the result itself rather than tracking a flag: no backup or rewrite unless a byte changed.
+    if text == orig:
         print("NOOP: nothing to change")
         return 0
 
     bak = TARGET.with_suffix(TARGET.suffix + ".bak.memalerts-me-proxy")
-    bak.write_text(orig, encoding="utf-8")
-    TARGET.write_text(text, encoding="utf-8")
+    # Keep the first backup: it is the pre-patch original, later runs only add to it.
+    if not bak.exists():
+        # The target is still the untouched original here: copy it on disk (sendfile on Linux).
+        shutil.copyfile(TARGET, bak)
+    write_atomic(TARGET, text)
     print(f"PATCHED: {TARGET} (backup: {bak})")
     return 0
 